@@ -1,38 +1,65 @@
 # app.py
+import hashlib
+import logging
 import os
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterator, Optional, Tuple, Union
 
-from flask import Flask, request, jsonify, send_from_directory
+import orjson
+from flask import Flask, Response, request, jsonify, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
+from werkzeug.exceptions import RequestEntityTooLarge
 from dotenv import load_dotenv
 
 # --- Google Generative AI SDK (Gemini) ---
 import google.generativeai as genai
+from google.generativeai import client as genai_client
 from google.generativeai.types import HarmCategory, HarmBlockThreshold
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
 
 # -----------------------------------------------------------------------------
 # Flask setup
 # -----------------------------------------------------------------------------
-app = Flask(__name__)
+class OrjsonProvider(DefaultJSONProvider):
+    """Routes jsonify() and request.get_json() through orjson."""
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return orjson.dumps(obj, default=self.default).decode()
+
+    def loads(self, s: Union[str, bytes], **kwargs: Any) -> Any:
+        return orjson.loads(s)
+
+
+# The frontend is served only from static/, never from the app directory (which
+# holds .env, the source and the KB). Decided once here; Flask's static route then
+# serves files directly.
+STATIC_DIR = Path(__file__).with_name("static")
+HAS_FRONTEND = STATIC_DIR.joinpath("index.html").exists()
+if not HAS_FRONTEND:
+    logger.warning("static/index.html not found; serving the API only.")
+
+app = Flask(__name__, static_folder=STATIC_DIR if HAS_FRONTEND else None, static_url_path="")
+app.json = OrjsonProvider(app)
+# Only the static/ frontend is sent as files, so this one-day browser cache
+# applies to it alone
+app.config["SEND_FILE_MAX_AGE_DEFAULT"] = 86400
+app.config["MAX_CONTENT_LENGTH"] = 64 * 1024  # request bodies are a single chat message
 CORS(app, resources={r"/api/*": {"origins": "*"}})
 
-# Serve static files (if you have a static folder)
 @app.route("/", methods=["GET"])
 def home():
-    # Try to serve from static folder first, fallback to current directory
-    try:
-        return send_from_directory('static', 'index.html')
-    except:
-        return send_from_directory('.', 'index.html')
-
-# Serve other static files if needed
-@app.route('/<path:path>')
-def serve_static(path):
-    try:
-        return send_from_directory('static', path)
-    except:
-        return send_from_directory('.', path)
+    if not HAS_FRONTEND:
+        return jsonify({"error": "Frontend not installed."}), 404
+    return app.send_static_file("index.html")
 
 # -----------------------------------------------------------------------------
 # Environment and Gemini client
@@ -47,8 +74,9 @@ if not GEMINI_API_KEY:
         "Add it to .env, e.g., GEMINI_API_KEY=your_key_here."
     )
 
-# Configure Gemini client
-genai.configure(api_key=GEMINI_API_KEY)
+# Configure Gemini client. The REST transport goes through plain sockets, which
+# the gevent workers (see gunicorn.conf.py) patch so in-flight calls yield.
+genai.configure(api_key=GEMINI_API_KEY, transport="rest")
 
 # Define Safety Settings (BLOCK_ONLY_HIGH for all categories)
 # This allows the assistant to address sensitive topics required for student support,
@@ -72,73 +100,501 @@ safety_settings = [
     },
 ]
 
-# Initialize model with updated name and safety settings
+SYSTEM_INSTRUCTION = (
+    "You are a compassionate student support assistant. "
+    "Provide brief, empathetic responses for academic/emotional stress. "
+    "For crisis situations (self-harm, unalive), immediately refer to counsellor booking. "
+    "Keep responses under 150 words."
+)
+
+# The stop sequence cuts off a reply that starts continuing the "Student:"
+# transcript format used in grounded prompts. max_output_tokens stays at 300:
+# gemini-2.5-flash's thinking tokens count against it too and this SDK can't set
+# a thinking budget, so a tighter cap would mostly cut replies short. Replies that
+# still end at MAX_TOKENS are handled in reply_text().
+GENERATION_CONFIG = {
+    "temperature": 0.2,
+    "max_output_tokens": 300,
+    "candidate_count": 1,
+    "stop_sequences": ["\n\nStudent:"],
+}
+
+# Per-call limit on a Gemini request. Without it a hung call would hold its
+# coalescing slot (see _coalesced_ai_response) indefinitely.
+GEMINI_REQUEST_OPTIONS = {"timeout": 30}
+
+SAFETY_FALLBACK_REPLY = (
+    "I am unable to process that specific request due to safety guidelines. "
+    "If you are experiencing a crisis, please seek immediate help or contact a "
+    "professional counsellor using the booking link."
+)
+
+INCOMPLETE_REPLY = (
+    "Sorry, I couldn't put together a reply to that just now. "
+    "Could you try asking again, perhaps a little more briefly?"
+)
+
+MAX_TOKENS = genai.protos.Candidate.FinishReason.MAX_TOKENS
+
+# Initialize model with updated name, safety settings and generation config.
+# Binding them here keeps call sites to just the contents; the SDK still converts
+# and merges these into each request.
 model = genai.GenerativeModel(
     model_name="gemini-2.5-flash", 
-    system_instruction=(
-        "You are a compassionate student support assistant. "
-        "Provide brief, empathetic responses for academic/emotional stress. "
-        "For crisis situations (self-harm, unalive), immediately refer to counsellor booking. "
-        "Keep responses under 150 words."
-    ),
-    safety_settings=safety_settings
+    system_instruction=SYSTEM_INSTRUCTION,
+    safety_settings=safety_settings,
+    generation_config=GENERATION_CONFIG,
 )
+
+# requests keeps only 10 idle connections per host by default, so beyond 10
+# concurrent Gemini calls each extra call would do a fresh TLS handshake and
+# then discard the connection. Size the pool to the worker's connection limit
+# (see gunicorn.conf.py).
+GEMINI_POOL_SIZE = int(os.environ.get("WORKER_CONNECTIONS", 500))
+
+
+def mount_gemini_pool() -> None:
+    # The SDK doesn't expose its REST session publicly; skip if the layout changes
+    session = getattr(getattr(genai_client.get_default_generative_client(), "_transport", None), "_session", None)
+    if session is None:
+        logger.warning("Could not find the Gemini REST session; using the default connection pool.")
+        return
+    session.mount("https://", HTTPAdapter(pool_maxsize=GEMINI_POOL_SIZE))
+
+
+mount_gemini_pool()
 # -----------------------------------------------------------------------------
-# AI Response Generation
+# Knowledge base retrieval
 # -----------------------------------------------------------------------------
+# Built from knowledge_base.json by build_kb_index.py
+KB_DB_PATH = Path(__file__).with_name("kb.sqlite3")
+
+# Knowledge base grounding is opt-in (KB_GROUNDING=1). By default Gemini sees only
+# the student message, as before; grounded prompts carry up to KB_TOP_K full
+# question/answer pairs, roughly 1k extra input tokens per call.
+KB_GROUNDING = os.getenv("KB_GROUNDING") == "1"
+
+# Number of knowledge base entries passed to the model as reference answers
+KB_TOP_K = 3
+
+# BM25 score an entry needs to be passed to the model at all, so small talk and
+# loosely related messages are sent without references
+KB_MIN_SCORE = float(os.getenv("KB_MIN_SCORE") or "8")
 
-def get_ai_response(student_message: str) -> str:
+# BM25 score at or above which the best entry's Response is returned directly,
+# skipping Gemini. Unset disables the shortcut.
+KB_DIRECT_SCORE = float(os.getenv("KB_DIRECT_SCORE") or "inf")
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text: str) -> List[str]:
+    return _TOKEN_RE.findall(text.lower())
+
+
+def open_kb_index() -> sqlite3.Connection:
     """
-    Generates a response from the Gemini model using only the system prompt.
+    Opens the FTS5 index read-only, shared by all requests in this process.
+    Only called with KB_GROUNDING on; then it fails at import if the index is
+    missing or unreadable, so a misconfigured deployment never serves requests.
     """
-    # Send only the student message (contents)
-    contents = student_message.strip()
+    if not KB_DB_PATH.exists():
+        raise RuntimeError(
+            f"Missing {KB_DB_PATH.name}. "
+            "Build it from knowledge_base.json with: python build_kb_index.py"
+        )
+
+    conn = sqlite3.connect(f"file:{KB_DB_PATH}?mode=ro", uri=True, check_same_thread=False)
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("SELECT count(*) FROM kb").fetchone()
+    return conn
+
+
+KB_DB: Optional[sqlite3.Connection] = open_kb_index() if KB_GROUNDING else None
 
-    response = model.generate_content(
-        contents,
-        generation_config={
-            "temperature": 0.2,
-            "max_output_tokens": 300,
-        }
+
+def retrieve_kb_entries(student_message: str) -> List[Dict[str, Any]]:
+    """
+    Returns up to KB_TOP_K entries whose Context best matches the message, best first,
+    each with its BM25 "score" (higher is better). Entries scoring below KB_MIN_SCORE
+    are dropped.
+    """
+    terms = dict.fromkeys(tokenize(student_message))
+    if KB_DB is None or not terms:
+        return []
+
+    # Quote every term so user text can't be parsed as FTS5 query syntax
+    query = " OR ".join(f'"{term}"' for term in terms)
+    rows = KB_DB.execute(
+        "SELECT context, response, -bm25(kb) FROM kb WHERE kb MATCH ? ORDER BY rank LIMIT ?",
+        (query, KB_TOP_K),
+    ).fetchall()
+    return [
+        {"Context": context, "Response": response, "score": score}
+        for context, response, score in rows
+        if score >= KB_MIN_SCORE
+    ]
+
+
+def build_llm_contents(student_message: str, kb_entries: List[Dict[str, Any]]) -> str:
+    """
+    Prepends the retrieved reference answers (if any) to the student message.
+    """
+    if not kb_entries:
+        return student_message
+
+    references = "\n\n".join(
+        f"Q: {entry['Context']}\nA: {entry['Response']}" for entry in kb_entries
     )
-    
+    return (
+        "Reference answers from the counselling knowledge base "
+        "(use them as guidance, do not copy them):\n\n"
+        f"{references}\n\nStudent: {student_message}"
+    )
+
+# -----------------------------------------------------------------------------
+# AI Response Generation
+# -----------------------------------------------------------------------------
+
+def prepare_llm_contents(student_message: str) -> Tuple[str, Optional[str]]:
+    """
+    Returns (contents, direct_reply). Without KB_GROUNDING the contents are just the
+    student message. direct_reply is set when a near-verbatim knowledge base question
+    can be answered locally without calling Gemini.
+    """
+    student_message = student_message.strip()
+    if not KB_GROUNDING:
+        return student_message, None
+
+    kb_entries = retrieve_kb_entries(student_message)
+
+    if kb_entries and kb_entries[0]["score"] >= KB_DIRECT_SCORE:
+        return student_message, kb_entries[0]["Response"]
+
+    return build_llm_contents(student_message, kb_entries), None
+
+
+def get_ai_response(student_message: str) -> Tuple[str, bool]:
+    """
+    Generates a response from the Gemini model, optionally grounded on the closest knowledge base entries.
+    Returns (reply, complete); see reply_text().
+    """
+    contents, direct_reply = prepare_llm_contents(student_message)
+    if direct_reply is not None:
+        return direct_reply, True
+
+    response = model.generate_content(contents, request_options=GEMINI_REQUEST_OPTIONS)
+    return reply_text(response)
+
+
+def reply_text(response: Any) -> Tuple[str, bool]:
+    """
+    Extracts the reply, substituting a fallback when Gemini returned no text.
+    complete is False when generation stopped at max_output_tokens, i.e. the reply
+    is cut off or a fallback; such replies must not be cached.
+    """
     # Check if the response was blocked due to safety and provide a fallback message
     if not response.candidates:
-        return "I am unable to process that specific request due to safety guidelines. If you are experiencing a crisis, please seek immediate help or contact a professional counsellor using the booking link."
+        return SAFETY_FALLBACK_REPLY, True
+
+    candidate = response.candidates[0]
+    complete = candidate.finish_reason != MAX_TOKENS
+    if not candidate.content.parts:
+        if not complete:
+            logger.warning("Gemini hit max_output_tokens before producing any text.")
+            return INCOMPLETE_REPLY, False
+        return SAFETY_FALLBACK_REPLY, True
+
+    if not complete:
+        logger.warning("Gemini reply was cut off at max_output_tokens.")
+    return (response.text or "").strip(), complete
+
+
+def stream_ai_response(student_message: str) -> Iterator[str]:
+    """
+    Same as get_ai_response, but yields the reply text as Gemini generates it.
+    """
+    contents, direct_reply = prepare_llm_contents(student_message)
+    if direct_reply is not None:
+        yield direct_reply
+        return
+
+    response = model.generate_content(contents, stream=True, request_options=GEMINI_REQUEST_OPTIONS)
+
+    sent_text = False
+    finish_reason = None
+    for chunk in response:
+        if not chunk.candidates:
+            yield SAFETY_FALLBACK_REPLY
+            return
+        finish_reason = chunk.candidates[0].finish_reason
+        # Chunks without text parts (e.g. the final finish_reason chunk) raise here
+        try:
+            text = chunk.text
+        except ValueError:
+            continue
+        if text:
+            sent_text = True
+            yield text
+
+    # Never end the stream silently: same fallbacks as reply_text()
+    if not sent_text:
+        if finish_reason == MAX_TOKENS:
+            logger.warning("Gemini hit max_output_tokens before producing any text.")
+            yield INCOMPLETE_REPLY
+        else:
+            yield SAFETY_FALLBACK_REPLY
+
+# -----------------------------------------------------------------------------
+# Crisis detection
+# -----------------------------------------------------------------------------
+# Crisis messages get the fixed counsellor referral below straight away instead
+# of waiting on (and depending on) the model. Phrasings this misses still reach
+# Gemini, whose system instruction asks for the same referral.
+CRISIS_PATTERN = re.compile(
+    r"\b(?:"
+    r"suicid\w*"
+    r"|kill(?:ing)? myself"
+    r"|unalive\w*"
+    r"|self[- ]?harm\w*"
+    r"|hurt(?:ing)? myself"
+    r"|(?:end|take)(?:ing)? my (?:own )?life"
+    r"|want(?:ed)? to die"
+    r")\b",
+    re.IGNORECASE,
+)
+
+CRISIS_REPLY = (
+    "I'm really sorry you're going through this, and you don't have to face it alone. "
+    "Please book a session with a counsellor right away using the counsellor booking link. "
+    "If you are in immediate danger, contact your local emergency number or a crisis helpline now."
+)
+
 
-    return (response.text or "").strip()
+def is_crisis_message(student_message: str) -> bool:
+    return CRISIS_PATTERN.search(student_message) is not None
+
+# -----------------------------------------------------------------------------
+# Reply cache
+# -----------------------------------------------------------------------------
+# Greetings and FAQ-style questions repeat often; identical messages reuse the
+# earlier reply instead of making another Gemini call. The cache is per process.
+REPLY_CACHE_SIZE = 2048
+
+# Replies keyed by normalized message, least recently used first
+_reply_cache: "OrderedDict[str, str]" = OrderedDict()
+_reply_cache_lock = threading.Lock()
+
+# Misses currently waiting on Gemini, keyed by normalized message. Concurrent
+# requests for the same message wait on the first one's call instead of issuing
+# their own.
+_inflight: Dict[str, Future] = {}
+_inflight_lock = threading.Lock()
+
+# Upper bound on how long a follower waits for the leader's call. Longer than the
+# leader's own Gemini timeout, so followers normally get its reply or its error.
+COALESCE_WAIT_SECONDS = GEMINI_REQUEST_OPTIONS["timeout"] + 10
+
+
+def normalize_message(student_message: str) -> str:
+    """Lower-cases and collapses whitespace so trivially different messages share a cache entry."""
+    return " ".join(student_message.lower().split())
+
+
+def _cache_get(key: str) -> Optional[str]:
+    with _reply_cache_lock:
+        reply = _reply_cache.get(key)
+        if reply is not None:
+            _reply_cache.move_to_end(key)
+        return reply
+
+
+def _cache_put(key: str, reply: str) -> None:
+    with _reply_cache_lock:
+        _reply_cache[key] = reply
+        _reply_cache.move_to_end(key)
+        if len(_reply_cache) > REPLY_CACHE_SIZE:
+            _reply_cache.popitem(last=False)
+
+
+def _coalesced_ai_response(key: str, student_message: str) -> str:
+    with _inflight_lock:
+        future = _inflight.get(key)
+        is_leader = future is None
+        if is_leader:
+            future = _inflight[key] = Future()
+
+    if is_leader:
+        try:
+            reply, complete = get_ai_response(student_message)
+            # A retry may produce a full reply, so don't pin a cut-off one
+            if complete:
+                _cache_put(key, reply)
+            future.set_result(reply)
+        except Exception as e:
+            future.set_exception(e)
+        except BaseException:
+            # gevent.Timeout / GreenletExit end the leader; followers get an ordinary
+            # error (and a 500) rather than waiting forever or being killed too
+            future.set_exception(RuntimeError("Gemini call was interrupted"))
+            raise
+        finally:
+            with _inflight_lock:
+                del _inflight[key]
+
+    return future.result(timeout=COALESCE_WAIT_SECONDS)
+
+
+def get_cached_ai_response(student_message: str) -> Tuple[str, bool]:
+    """
+    Returns (reply, cache_hit). The normalized message is only the cache key;
+    Gemini always sees the student's own wording. Crisis messages are answered
+    before reaching here.
+    """
+    key = normalize_message(student_message)
+    reply = _cache_get(key)
+    if reply is not None:
+        return reply, True
+
+    return _coalesced_ai_response(key, student_message), False
+
+# -----------------------------------------------------------------------------
+# Warm-up
+# -----------------------------------------------------------------------------
+def warm_up() -> None:
+    """
+    Opens the Gemini HTTPS connection and (with KB_GROUNDING) pages in the KB index so the first real
+    request doesn't pay for the TLS handshake, DNS lookup and cold reads.
+    Set GEMINI_WARMUP=0 to skip the (one-token) Gemini ping.
+    """
+    try:
+        retrieve_kb_entries("warm up")
+        if os.getenv("GEMINI_WARMUP", "1") != "0":
+            model.generate_content(
+                "ping",
+                generation_config={"max_output_tokens": 1},
+                request_options=GEMINI_REQUEST_OPTIONS,
+            )
+    except Exception as e:
+        logger.warning("Warm-up failed: %s", e)
+
+
+def start_warm_up() -> None:
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
 
 # -----------------------------------------------------------------------------
 # API endpoint
 # -----------------------------------------------------------------------------
-@app.route("/api/chat", methods=["POST"])
-def chat():
+MAX_MESSAGE_CHARS = 4000
+
+
+def read_student_message() -> Tuple[str, Optional[Tuple[Response, int]]]:
+    """
+    Parses the request body. Returns (message, None) or ("", error_response).
+    """
     try:
         payload = request.get_json(force=True, silent=False) or {}
-        print("Incoming payload:", payload, flush=True)  # Debug print
+        logger.debug("Incoming payload: %s", payload)
+    except RequestEntityTooLarge:
+        return "", (jsonify({"error": "Message too long."}), 413)
     except Exception:
-        return jsonify({"error": "Invalid JSON body."}), 400
+        return "", (jsonify({"error": "Invalid JSON body."}), 400)
+
+    if not isinstance(payload, dict):
+        return "", (jsonify({"error": "Request body must be a JSON object."}), 400)
 
-    student_message = (payload.get("message") or "").strip()
+    student_message = payload.get("message") or ""
+    if not isinstance(student_message, str):
+        return "", (jsonify({"error": "'message' must be a string."}), 400)
+
+    student_message = student_message.strip()
     if not student_message:
-        return jsonify({"error": "Missing 'message' in request body."}), 400
+        return "", (jsonify({"error": "Missing 'message' in request body."}), 400)
 
-    try:
-        # Note: No FileNotFoundError possible anymore since knowledge_base.json is removed.
-        reply = get_ai_response(student_message)
-        return jsonify({"reply": reply}), 200
+    # Oversized input is rejected before it costs a KB query or Gemini tokens
+    if len(student_message) > MAX_MESSAGE_CHARS:
+        return "", (jsonify({"error": "Message too long."}), 413)
 
-    except Exception as e:
-        print(f"Error in chat endpoint: {str(e)}")  # Debug print
+    return student_message, None
+
+
+def sse_event(data: str, event: Optional[str] = None) -> str:
+    """Formats one Server-Sent Event; multi-line data is split across data: fields."""
+    lines = [f"event: {event}"] if event else []
+    lines += [f"data: {line}" for line in data.split("\n")]
+    return "\n".join(lines) + "\n\n"
+
+
+@app.route("/api/chat", methods=["POST"])
+def chat():
+    student_message, error = read_student_message()
+    if error:
+        return error
+
+    # Crisis replies skip the model and must never be reused by a browser or CDN
+    if is_crisis_message(student_message):
+        response = jsonify({"reply": CRISIS_REPLY})
+        response.headers["Cache-Control"] = "no-store"
+        return response, 200
+
+    try:
+        reply, cache_hit = get_cached_ai_response(student_message)
+    except Exception:
+        logger.exception("Error in chat endpoint")
         return jsonify({"error": "Server error processing your message."}), 500
 
+    # Browsers and CDNs don't store POST responses, so these headers only help
+    # custom clients that track the ETag themselves. A matching If-None-Match on a
+    # POST is a failed precondition (412), not a 304; the reply has been computed
+    # by then either way.
+    etag = hashlib.sha256(reply.encode()).hexdigest()[:16]
+    if request.if_none_match.contains(etag):
+        response = Response(status=412)
+    else:
+        response = jsonify({"reply": reply})
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, max-age=60, stale-while-revalidate=300"
+    response.headers["X-Cache"] = "HIT" if cache_hit else "MISS"
+    return response
+
+
+@app.route("/api/chat/stream", methods=["POST"])
+def chat_stream():
+    student_message, error = read_student_message()
+    if error:
+        return error
+
+    def generate() -> Iterator[str]:
+        if is_crisis_message(student_message):
+            yield sse_event(CRISIS_REPLY)
+            yield sse_event("", event="done")
+            return
+        try:
+            for text in stream_ai_response(student_message):
+                yield sse_event(text)
+        except Exception:
+            logger.exception("Error in chat stream endpoint")
+            yield sse_event("Server error processing your message.", event="error")
+            return
+        yield sse_event("", event="done")
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 # -----------------------------------------------------------------------------
 # Main entry
 # -----------------------------------------------------------------------------
 if __name__ == "__main__":
-    # Check if index.html exists
-    if not Path("index.html").exists() and not Path("static/index.html").exists():
-        print("WARNING: index.html not found. Please create it in the root or static folder.")
-    
-    print("Starting server on http://0.0.0.0:8000")
-    app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 8000)), debug=True)
\ No newline at end of file
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    # Development server only; production runs under gunicorn (see gunicorn.conf.py)
+    start_warm_up()
+    logger.info("Starting server on http://0.0.0.0:8000")
+    app.run(
+        host="0.0.0.0",
+        port=int(os.environ.get("PORT", 8000)),
+        debug=os.environ.get("FLASK_DEBUG") == "1",
+    )
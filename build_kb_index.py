@@ -0,0 +1,68 @@
+# build_kb_index.py
+"""
+Builds kb.sqlite3, the SQLite FTS5 index app.py retrieves knowledge base entries from.
+
+Run after changing knowledge_base.json:
+
+    python build_kb_index.py
+"""
+import os
+import sqlite3
+from pathlib import Path
+from typing import List, Dict
+
+import orjson
+
+KB_JSON_PATH = Path(__file__).with_name("knowledge_base.json")
+KB_DB_PATH = Path(__file__).with_name("kb.sqlite3")
+
+
+def load_knowledge_base(path: Path = KB_JSON_PATH) -> List[Dict[str, str]]:
+    """
+    Loads the Context/Response pairs from knowledge_base.json, skipping malformed entries.
+    """
+    with path.open("rb") as f:
+        data = orjson.loads(f.read())
+
+    return [
+        {"Context": item["Context"], "Response": item["Response"]}
+        for item in data
+        if isinstance(item, dict)
+        and isinstance(item.get("Context"), str)
+        and isinstance(item.get("Response"), str)
+    ]
+
+
+def index_is_stale(json_path: Path = KB_JSON_PATH, db_path: Path = KB_DB_PATH) -> bool:
+    return not db_path.exists() or db_path.stat().st_mtime < json_path.stat().st_mtime
+
+
+def build_index(json_path: Path = KB_JSON_PATH, db_path: Path = KB_DB_PATH) -> int:
+    """
+    (Re)creates the index from json_path and returns the number of entries written.
+    The new file replaces db_path atomically, so running processes never see a partial index.
+    """
+    entries = load_knowledge_base(json_path)
+    tmp_path = db_path.with_name(db_path.name + ".tmp")
+    tmp_path.unlink(missing_ok=True)
+
+    conn = sqlite3.connect(tmp_path)
+    try:
+        # Only Context is searched; Response is stored alongside it
+        conn.execute("CREATE VIRTUAL TABLE kb USING fts5(context, response UNINDEXED)")
+        conn.executemany(
+            "INSERT INTO kb (context, response) VALUES (?, ?)",
+            [(item["Context"], item["Response"]) for item in entries],
+        )
+        conn.execute("INSERT INTO kb (kb) VALUES ('optimize')")
+        conn.commit()
+    finally:
+        conn.close()
+
+    os.replace(tmp_path, db_path)
+    return len(entries)
+
+
+if __name__ == "__main__":
+    count = build_index()
+    print(f"Indexed {count} entries from {KB_JSON_PATH.name} into {KB_DB_PATH.name}")
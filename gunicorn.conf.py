@@ -0,0 +1,30 @@
+# gunicorn.conf.py
+import os
+
+# Gemini calls are network-bound, so gevent workers let each process keep many
+# requests in flight instead of blocking one worker per round-trip.
+bind = f"0.0.0.0:{os.environ.get('PORT', 8000)}"
+worker_class = "gevent"
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+worker_connections = int(os.environ.get("WORKER_CONNECTIONS", 500))
+timeout = 60
+
+
+def on_starting(server):
+    # Build the knowledge base index once in the master, before workers open it.
+    # Only grounded deployments (KB_GROUNDING=1) use it.
+    if os.environ.get("KB_GROUNDING") != "1":
+        return
+
+    import build_kb_index
+
+    if build_kb_index.index_is_stale():
+        count = build_kb_index.build_index()
+        server.log.info("Indexed %d knowledge base entries into %s", count, build_kb_index.KB_DB_PATH.name)
+
+
+def post_worker_init(worker):
+    # The app module is already imported by the worker at this point
+    import app
+
+    app.start_warm_up()